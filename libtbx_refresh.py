@@ -271,21 +271,26 @@ def _install_dials_autocompletion():
 
     # Set the location of the output directory
     output_directory = libtbx.env.under_build(os.path.join("dials", "autocomplete"))
-    try:
-        os.makedirs(output_directory)
-    except OSError:
-        pass
+    os.makedirs(output_directory, exist_ok=True)
 
     # Build a list of autocompleteable commands
     commands_dir = os.path.join(dist_path, "src", "dials", "command_line")
     command_list = []
-    for filename in sorted(os.listdir(commands_dir)):
-        if not filename.startswith("_") and filename.endswith(".py"):
-            # Check if this file marks itself as completable
-            with open(os.path.join(commands_dir, filename), "rb") as f:
-                if b"DIALS_ENABLE_COMMAND_LINE_COMPLETION" in f.read():
-                    command_name = f"dials.{filename[:-3]}"
-                    command_list.append(command_name)
+    with os.scandir(commands_dir) as entries:
+        filenames = sorted(
+            entry.name
+            for entry in entries
+            if entry.is_file()
+            and not entry.name.startswith("_")
+            and entry.name.endswith(".py")
+        )
+    for filename in filenames:
+        # Check if this file marks itself as completable. The marker is always
+        # at the top of the file, so there is no need to read the whole file.
+        with open(os.path.join(commands_dir, filename), "rb") as f:
+            if b"DIALS_ENABLE_COMMAND_LINE_COMPLETION" in f.read(4096):
+                command_name = f"dials.{filename[:-3]}"
+                command_list.append(command_name)
     print("Identified autocompletable commands: " + " ".join(command_list))
 
     # Generate the autocompletion SConscript.
@@ -539,19 +539,15 @@ def sort_deltacchalf_values(delta_cchalf_i, results_summary):
 
         Also add the sorted lists to the results summary. Datasets are sorted
         from low to high based on deltacchalf values."""
-        datasets = list(delta_cchalf_i.keys())
-        sorted_index = sorted(
-            range(len(datasets)), key=lambda x: delta_cchalf_i[datasets[x]]
-        )
+        datasets = flex.int(list(delta_cchalf_i.keys()))
+        cc_half_values = flex.double(list(delta_cchalf_i.values()))
 
         # sorted by deltacchalf from low to high
-        sorted_cc_half_values = flex.double([])
-        sorted_datasets = flex.int([])
-        for i in sorted_index:
-            val = delta_cchalf_i[datasets[i]]
-            logger.info("Dataset: %d, ΔCC½: %.3f", datasets[i], 100 * val)
-            sorted_cc_half_values.append(val)
-            sorted_datasets.append(datasets[i])
+        perm = flex.sort_permutation(cc_half_values)
+        sorted_cc_half_values = cc_half_values.select(perm)
+        sorted_datasets = datasets.select(perm)
+        for dataset, val in zip(sorted_datasets, sorted_cc_half_values):
+            logger.info("Dataset: %d, ΔCC½: %.3f", dataset, 100 * val)
 
         results_summary["per_dataset_delta_cc_half_values"] = {
             "datasets": list(sorted_datasets),
@@ -4,6 +4,8 @@
 from collections import defaultdict
 from math import floor, sqrt
 
+import numpy as np
+
 from cctbx import crystal, miller
 
 from dials.array_family import flex
@@ -153,6 +155,60 @@ def compute_cchalf_from_reflection_sums(reflection_sums, binner):
     return compute_mean_cchalf_in_bins(bin_data)
 
 
+def _compute_bin_moments(sum_x, sum_x2, n, bin_index, nbins):
+    """
+    Accumulate the sums over unique reflections needed to compute the CC 1/2 in
+    resolution bins. Only reflections with more than one observation contribute.
+
+    :param sum_x: The sum of intensities for each unique reflection
+    :param sum_x2: The sum of squared intensities for each unique reflection
+    :param n: The number of observations of each unique reflection
+    :param bin_index: The resolution bin of each unique reflection
+    :param nbins: The number of resolution bins
+    :returns: An array of shape (4, nbins) containing the number of unique
+              reflections, the sum of the means, the sum of the squared means and
+              the sum of the variances on the means in each bin
+    """
+    sel = n > 1
+    n = n[sel]
+    mean = sum_x[sel] / n
+    var = (sum_x2[sel] - sum_x[sel] ** 2 / n) / (n - 1)
+    var = var / n
+    index = bin_index[sel]
+    return np.stack(
+        [
+            np.bincount(index, minlength=nbins),
+            np.bincount(index, weights=mean, minlength=nbins),
+            np.bincount(index, weights=mean**2, minlength=nbins),
+            np.bincount(index, weights=var, minlength=nbins),
+        ]
+    )
+
+
+def _compute_mean_cchalf_from_bin_moments(moments):
+    """
+    Compute the mean cchalf averaged across resolution bins, using the per-bin
+    sums calculated by _compute_bin_moments
+
+    :param moments: The per-bin sums
+    :returns: The mean CC 1/2
+    """
+    count, sum_mean, sum_mean2, sum_var = moments
+    sel = count > 1
+    n = count[sel]
+    mean_of_means = sum_mean[sel] / n
+    sigma_e = sum_var[sel] / n
+    sigma_y = (sum_mean2[sel] - n * mean_of_means**2) / (n - 1)
+    cchalf = (sigma_y - sigma_e) / (sigma_y + sigma_e)
+    count = np.sum(n)
+    if count == 0:
+        # As for compute_mean_cchalf_in_bins, rather than returning nan
+        raise ZeroDivisionError(
+            "No resolution bin contains more than one unique reflection"
+        )
+    return np.sum(n * cchalf) / count
+
+
 class PerGroupCChalfStatistics:
     def __init__(
         self,
@@ -265,43 +321,73 @@ def _compute_cchalf_excluding_each_group(self):
         """
         Compute the CC 1/2 with an image excluded.
 
-        For each image, update the sums by removing the contribution from the image
-        and then compute the CC 1/2 of the remaining data
+        The per-bin sums required for the CC 1/2 are computed once for all the
+        data. For each image, only the contribution of the unique reflections
+        observed on that image is removed from these sums, before computing the
+        CC 1/2 of the remaining data
         """
 
-        # Create a lookup table for each reflection by dataset i.e. group of images
-        dataset_lookup = defaultdict(list)
-        for i, b in enumerate(self.reflection_table["group"]):
-            dataset_lookup[b].append(i)
+        # Map each observation to its unique reflection, and each unique
+        # reflection to its resolution bin
+        unique_lookup = {h: i for i, h in enumerate(self.reflection_sums)}
+        hkl_index = np.array(
+            [unique_lookup[h] for h in self.reflection_table["miller_index"]]
+        )
+        bin_index = np.array([self.binner.index(h) for h in self.reflection_sums])
+        nbins = self.binner.nbins()
+
+        # The overall Sum(X), Sum(X^2) and counts for each unique reflection
+        sums = self.reflection_sums.values()
+        sum_x = np.array([s.sum_x for s in sums], dtype=np.float64)
+        sum_x2 = np.array([s.sum_x2 for s in sums], dtype=np.float64)
+        n = np.array([s.n for s in sums])
+        moments = _compute_bin_moments(sum_x, sum_x2, n, bin_index, nbins)
+
+        # Sort the observations so those from each dataset i.e. group of images
+        # are contiguous
+        intensity = self.reflection_table["intensity"].as_numpy_array()
+        group = self.reflection_table["group"].as_numpy_array()
+        order = np.argsort(group, kind="stable")
+        datasets, starts, counts = np.unique(
+            group[order], return_index=True, return_counts=True
+        )
 
         # Compute CC1/2 minus each dataset
         cchalf_i = {}
-        for dataset in dataset_lookup:
-
-            # Find all observations from this dataset and create a lookup based on
-            # miller index
-            index_lookup = defaultdict(list)
-            for i in dataset_lookup[dataset]:
-                index_lookup[self.reflection_table["miller_index"][i]].append(i)
-
-            # Loop through all the reflections and remove the contribution of
-            # reflections from the current dataset
-            dataset_reflection_sums = defaultdict(ReflectionSum)
-            for h in self.reflection_sums:
-                sum_x = self.reflection_sums[h].sum_x
-                sum_x2 = self.reflection_sums[h].sum_x2
-                n = self.reflection_sums[h].n
-                for i in index_lookup[h]:
-                    sum_x -= self.reflection_table["intensity"][i]
-                    sum_x2 -= self.reflection_table["intensity"][i] ** 2
-                    n -= 1
-                dataset_reflection_sums[h] = ReflectionSum(sum_x, sum_x2, n)
+        for dataset, start, count in zip(datasets, starts, counts):
+            sel = order[start : start + count]
+
+            # Find the unique reflections observed in this dataset and sum their
+            # contributions
+            touched, inverse = np.unique(hkl_index[sel], return_inverse=True)
+            inverse = inverse.ravel()
+            dataset_sum_x = np.bincount(inverse, weights=intensity[sel])
+            dataset_sum_x2 = np.bincount(inverse, weights=intensity[sel] ** 2)
+            dataset_n = np.bincount(inverse)
+
+            # Replace the contribution of these reflections to the per-bin sums
+            # with that of the remaining observations
+            dataset_moments = (
+                moments
+                - _compute_bin_moments(
+                    sum_x[touched],
+                    sum_x2[touched],
+                    n[touched],
+                    bin_index[touched],
+                    nbins,
+                )
+                + _compute_bin_moments(
+                    sum_x[touched] - dataset_sum_x,
+                    sum_x2[touched] - dataset_sum_x2,
+                    n[touched] - dataset_n,
+                    bin_index[touched],
+                    nbins,
+                )
+            )
 
             # Compute the CC 1/2 without the reflections from the current dataset
-            cchalf = compute_cchalf_from_reflection_sums(
-                dataset_reflection_sums, self.binner
-            )
-            cchalf_i[dataset] = cchalf
+            cchalf = _compute_mean_cchalf_from_bin_moments(dataset_moments)
+            cchalf_i[int(dataset)] = cchalf
             logger.info("CC 1/2 excluding group %d: %.3f", dataset, 100 * cchalf)
 
         return cchalf_i
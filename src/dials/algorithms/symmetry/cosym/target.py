@@ -3,12 +3,12 @@
 from __future__ import annotations
 
 import copy
-import itertools
 import logging
 import warnings
 
 import numpy as np
-import pandas as pd
+import scipy.linalg
+import scipy.sparse
 from orderedset import OrderedSet
 
 import cctbx.sgtbx.cosets
@@ -18,6 +18,109 @@
 logger = logging.getLogger(__name__)
 
 
+def _intensities_as_sparse_matrix(rows, columns, data, shape):
+    """Gather intensities into a sparse matrix.
+
+    Where an element occurs more than once, e.g. a miller index that is observed
+    more than once in the same lattice, only the last intensity is kept, as for
+    assignment of the intensities into a dense array.
+
+    Args:
+      rows (np.ndarray): The row of each intensity.
+      columns (np.ndarray): The column of each intensity.
+      data (np.ndarray): The intensities.
+      shape (Tuple[int, int]): The shape of the matrix.
+
+    Returns:
+      scipy.sparse.csr_matrix: The sparse matrix of intensities, in canonical
+      format.
+    """
+    flat = np.ravel_multi_index((rows, columns), shape)
+    _, last = np.unique(flat[::-1], return_index=True)
+    last = flat.size - 1 - last
+    return scipy.sparse.csr_matrix(
+        (data[last], (rows[last], columns[last])), shape=shape
+    )
+
+
+def _compute_symmetric_product(a, block_size):
+    """Compute the symmetric matrix product a @ a.T as a dense array.
+
+    The rows of `a` are split into blocks, and only the blocks of the product on
+    or above the diagonal are evaluated. The blocks below the diagonal are filled
+    in from their transposes, so the result is exactly symmetric.
+
+    Args:
+      a (scipy.sparse.csr_matrix): The sparse matrix to multiply by its transpose.
+      block_size (int): The number of rows in each block.
+
+    Returns:
+      np.ndarray: The dense, symmetric matrix product.
+    """
+    n_rows = a.shape[0]
+    product = np.empty((n_rows, n_rows))
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        block = (a[start:stop] @ a[start:].T).toarray()
+        product[start:stop, start:] = block
+        product[stop:, start:stop] = block[:, stop - start :].T
+    return product
+
+
+def _compute_pairwise_correlations(intensities, min_pairs, block_size=None):
+    """Compute the correlation coefficients between all pairs of rows.
+
+    Each correlation coefficient is calculated using only those columns for which
+    an intensity is present in both rows. The sums over these common columns are
+    evaluated for all pairs of rows at once as sparse matrix products.
+
+    Args:
+      intensities (scipy.sparse.csr_matrix): A sparse matrix of intensities, in
+        canonical format, where only the intensities that are present are stored.
+      min_pairs (int): The minimum number of common columns required to
+        calculate a correlation coefficient.
+      block_size (int): The number of rows in each block when evaluating the
+        symmetric products of the rows. Defaults to a single block of all rows.
+
+    Returns:
+      Tuple[np.ndarray, np.ndarray]: The matrix of correlation coefficients, set
+      to zero where they could not be calculated, and the matrix of the number of
+      common columns for each pair of rows.
+    """
+    n_obs = np.diff(intensities.indptr)
+    m = intensities.copy()
+    m.data = np.ones_like(m.data)
+
+    # Subtract the mean of each row to minimise rounding errors in the sums below
+    row_means = np.divide(
+        np.asarray(intensities.sum(axis=1)).ravel(),
+        n_obs,
+        out=np.zeros(n_obs.size),
+        where=n_obs > 0,
+    )
+    x = intensities.copy()
+    x.data -= np.repeat(row_means, n_obs)
+
+    # For each pair of rows (i, j), sum over the columns common to both rows
+    if block_size is None:
+        block_size = intensities.shape[0]
+    mt = m.T.tocsr()
+    n = _compute_symmetric_product(m, block_size)
+    sum_x = (x @ mt).toarray()
+    sum_xx = (x.power(2) @ mt).toarray()
+    sum_xy = _compute_symmetric_product(x, block_size)
+
+    covariance = n * sum_xy - sum_x * sum_x.T
+    variance = n * sum_xx - np.square(sum_x)
+    with np.errstate(invalid="ignore"):
+        denominator = np.sqrt(variance * variance.T)
+    rij = np.zeros_like(covariance)
+    np.divide(
+        covariance, denominator, out=rij, where=(n >= min_pairs) & (denominator > 0)
+    )
+    return rij, n
+
+
 class Target:
     """Target function for cosym analysis.
 
@@ -71,23 +174,20 @@ def __init__(
         cb_op_to_primitive = data.change_of_basis_op_to_primitive_setting()
         data = data.change_basis(cb_op_to_primitive).map_to_asu()
 
-        # Convert to uint64 avoids crashes on Windows when later constructing
-        # flex.size_t (https://github.com/cctbx/cctbx_project/issues/591)
-        order = lattice_ids.argsort().astype(np.uint64)
-        sorted_data = data.data().select(flex.size_t(order))
-        sorted_indices = data.indices().select(flex.size_t(order))
-        self._lattice_ids = lattice_ids[order]
+        # Sort with flex, rather than converting a numpy argsort to flex.size_t,
+        # which crashes on Windows unless first cast to uint64
+        # (https://github.com/cctbx/cctbx_project/issues/591)
+        order = flex.sort_permutation(flex.int(lattice_ids.astype(np.int32)))
+        sorted_data = data.data().select(order)
+        sorted_indices = data.indices().select(order)
+        self._lattice_ids = lattice_ids[order.as_numpy_array()]
         self._data = data.customized_copy(indices=sorted_indices, data=sorted_data)
         assert isinstance(self._data.indices(), type(flex.miller_index()))
         assert isinstance(self._data.data(), type(flex.double()))
 
-        # construct a lookup for the separate lattices
-        self._lattices = np.array(
-            [
-                np.where(self._lattice_ids == i)[0][0]
-                for i in np.unique(self._lattice_ids)
-            ]
-        )
+        # construct a lookup for the separate lattices, i.e. the index of the first
+        # reflection of each lattice in the sorted data
+        _, self._lattices = np.unique(self._lattice_ids, return_index=True)
 
         self.sym_ops = OrderedSet(["x,y,z"])
         self._lattice_group = lattice_group
@@ -111,6 +211,30 @@ def __init__(
         )
 
         self.rij_matrix, self.wij_matrix = self._compute_rij_wij()
+        self._xtx_cache = None
+
+        # Only elements with a non-zero weight contribute to the target function, so
+        # if few of the weights are non-zero, keep the weights and the corresponding
+        # rij in sparse form. If most lattices share reflections, as is typical, the
+        # weights are nearly dense and the dense elementwise evaluation is faster.
+        self._wij = None
+        if (
+            self.wij_matrix is not None
+            and np.count_nonzero(self.wij_matrix) < 0.5 * self.wij_matrix.size
+        ):
+            self._wij = scipy.sparse.csr_matrix(self.wij_matrix)
+            wij_rows = np.repeat(
+                np.arange(self._wij.shape[0], dtype=np.int32),
+                np.diff(self._wij.indptr),
+            )
+            self._rij_at_wij = self.rij_matrix[wij_rows, self._wij.indices]
+            # Both rij and x.T @ x are symmetric, so only their upper triangles need
+            # to be read: map each element with a non-zero weight onto the upper
+            # triangle
+            self._wij_upper = (
+                np.minimum(wij_rows, self._wij.indices),
+                np.maximum(wij_rows, self._wij.indices),
+            )
 
     def set_dimensions(self, dimensions):
         """Set the number of dimensions for analysis.
@@ -171,86 +295,83 @@ def _compute_rij_wij(self, use_cache=True):
 
         # Pre-calculate miller indices after application of each cb_op. Only calculate
         # this once per cb_op instead of on-the-fly every time we need it.
-        indices = {}
-        epsilons = {}
+        cb_ops = [sgtbx.change_of_basis_op(cb_op) for cb_op in self.sym_ops]
+        all_indices = np.empty((n_sym_ops, self._data.size(), 3), dtype=np.int32)
+        keep = []
         space_group_type = self._data.space_group().type()
-        for cb_op in self.sym_ops:
-            cb_op = sgtbx.change_of_basis_op(cb_op)
+        for k, cb_op in enumerate(cb_ops):
             indices_reindexed = cb_op.apply(self._data.indices())
             miller.map_to_asu(space_group_type, False, indices_reindexed)
-            cb_op_str = cb_op.as_xyz()
-            indices[cb_op_str] = np.array(
-                [
-                    h.iround().as_numpy_array()
-                    for h in indices_reindexed.as_vec3_double().parts()
-                ]
-            ).transpose()
-            epsilons[cb_op_str] = self._patterson_group.epsilon(
-                indices_reindexed
-            ).as_numpy_array()
+            all_indices[k] = (
+                indices_reindexed.as_vec3_double().as_double().as_numpy_array()
+            ).reshape(-1, 3)
+            # Only reflections with epsilon == 1 are used to calculate the
+            # correlation coefficients
+            keep.append(
+                self._patterson_group.epsilon(indices_reindexed).as_numpy_array() == 1
+            )
         intensities = self._data.data().as_numpy_array()
 
-        # Map indices to an array of flat 1d indices which can later be used for
-        # matching pairs of indices
-        offset = -np.min(np.concatenate(list(indices.values())), axis=0)
-        dims = np.max(np.concatenate(list(indices.values())), axis=0) + offset + 1
-        for cb_op, hkl in indices.items():
-            indices[cb_op] = np.ravel_multi_index((hkl + offset).T, dims)
-
-        # Create an empty 2D array of shape (m * n, L), where m is the number of sym
-        # ops, n is the number of lattices, and L is the number of unique miller indices
-        all_intensities = np.empty((n_sym_ops * n_lattices, np.prod(dims)))
-
-        # Populate all_intensities with intensity values, filling absent intensities
-        # with np.nan
-        all_intensities.fill(np.nan)
-        slices = np.append(self._lattices, intensities.size)
-        slices = list(map(slice, slices[:-1], slices[1:]))
-        for i, (mil_ind, eps) in enumerate(zip(indices.values(), epsilons.values())):
-            for j, selection in enumerate(slices):
-                # map (i, j) to a column in all_intensities
-                column = np.ravel_multi_index((i, j), (n_sym_ops, n_lattices))
-                epsilon_equals_one = eps[selection] == 1
-                valid_mil_ind = mil_ind[selection][epsilon_equals_one]
-                valid_intensities = intensities[selection][epsilon_equals_one]
-                all_intensities[column, valid_mil_ind] = valid_intensities
-
-        # Ideally we would use `np.ma.corrcoef` here, but it is broken, so use
-        # pd.DataFrame.corr() instead (see numpy/numpy#15601)
-        rij = (
-            pd.DataFrame(all_intensities)
-            .T.dropna(how="all")
-            .corr(min_periods=self._min_pairs)
-            .values
+        # Map indices to an array of flat 1d indices, and then to contiguous ids of
+        # the unique miller indices shared between all cb_ops, which can later be
+        # used for matching pairs of indices
+        all_indices = all_indices.reshape(-1, 3)
+        offset = -np.min(all_indices, axis=0)
+        dims = np.max(all_indices, axis=0) + offset + 1
+        unique_indices, hkl_ids = np.unique(
+            np.ravel_multi_index((all_indices + offset).T, dims), return_inverse=True
+        )
+        # The ids and lattice indices comfortably fit in int32, which halves the
+        # memory traffic when gathering the rows of the intensity matrix below
+        indices = np.split(hkl_ids.astype(np.int32), len(cb_ops))
+
+        # Gather the intensity values into a sparse 2D array of shape (m * n, L),
+        # where m is the number of sym ops, n is the number of lattices, and L is
+        # the number of unique miller indices
+        lattice_index = np.repeat(
+            np.arange(n_lattices, dtype=np.int32),
+            np.diff(np.append(self._lattices, intensities.size)),
+        )
+        n_keep = sum(int(np.count_nonzero(sel)) for sel in keep)
+        rows = np.empty(n_keep, dtype=np.int32)
+        columns = np.empty(n_keep, dtype=np.int32)
+        data = np.empty(n_keep, dtype=np.float64)
+        m = 0
+        for i, (mil_ind, sel) in enumerate(zip(indices, keep)):
+            n = np.count_nonzero(sel)
+            # map (i, lattice) to a row in all_intensities
+            rows[m : m + n] = i * n_lattices + lattice_index[sel]
+            columns[m : m + n] = mil_ind[sel]
+            data[m : m + n] = intensities[sel]
+            m += n
+
+        all_intensities = _intensities_as_sparse_matrix(
+            rows, columns, data, (n_sym_ops * n_lattices, unique_indices.size)
+        )
+
+        # The (k, kk) and (kk, k) blocks of sym ops are transposes of each other, so
+        # only evaluate the blocks with k <= kk
+        rij, n_pairs = _compute_pairwise_correlations(
+            all_intensities, self._min_pairs, block_size=n_lattices
         )
-        # Set any NaN correlation coefficients to zero
-        np.nan_to_num(rij, copy=False)
         # Cosym does not make use of the on-diagonal correlation coefficients
         np.fill_diagonal(rij, 0)
 
         if self._weights:
-            wij = np.zeros_like(rij)
-            right_up = np.triu_indices_from(wij, k=1)
-
             # For each correlation coefficient, set the weight equal to the size of
             # the sample used to calculate that coefficient
-            pairwise_combos = itertools.combinations(np.isfinite(all_intensities), 2)
-            sample_size = lambda x, y: np.count_nonzero(x & y)
-            wij[right_up] = list(itertools.starmap(sample_size, pairwise_combos))
+            wij = n_pairs
+            np.fill_diagonal(wij, 0)
 
             if self._weights == "standard_error":
                 # Set each weights as the reciprocal of the standard error on the
                 # corresponding correlation coefficient
                 # http://www.sjsu.edu/faculty/gerstman/StatPrimer/correlation.pdf
+                # Evaluate in-place, only for elements where n > 2
+                sel = wij > 2
                 with np.errstate(divide="ignore", invalid="ignore"):
-                    reciprocal_se = np.sqrt(
-                        (wij[right_up] - 2) / (1 - np.square(rij[right_up]))
-                    )
-
-                wij[right_up] = np.where(wij[right_up] > 2, reciprocal_se, 0)
-
-            # Symmetrise the wij matrix
-            wij += wij.T
+                    wij[sel] = np.sqrt((wij[sel] - 2) / (1 - np.square(rij[sel])))
+                wij[~sel] = 0
         else:
             wij = None
 
@@ -270,11 +391,96 @@ def compute_functional(self, x: np.ndarray) -> float:
         """
         assert (x.size // self.dim) == (len(self._lattices) * len(self.sym_ops))
         x = x.reshape((self.dim, x.size // self.dim))
-        elements = np.square(self.rij_matrix - x.T @ x)
+        return self._compute_functional_from_xtx(self._compute_xtx(x))
+
+    def _compute_xtx(self, x):
+        """Compute the matrix product x.T @ x.
+
+        The minimisers evaluate the functional and the gradients at the same
+        coordinates in turn, so the result for the most recent coordinates is
+        cached and reused while `x` is unchanged.
+
+        When sparse weights are used, the target function only reads the upper
+        triangle of x.T @ x, so only the upper triangle is calculated, using the
+        symmetric rank-k update (dsyrk) which needs half the operations of a general
+        matrix product.
+
+        Args:
+          x (np.ndarray): The coordinates, of shape (dim, NN).
+
+        Returns:
+          np.ndarray: The matrix product x.T @ x, of shape (NN, NN), or its upper
+          triangle if sparse weights are used. This must not be modified by the
+          caller.
+        """
+        if self._xtx_cache is None or not np.array_equal(x, self._xtx_cache[0]):
+            if self._wij is not None:
+                xtx = scipy.linalg.blas.dsyrk(1.0, x.T, trans=0, lower=0)
+            else:
+                xtx = x.T @ x
+            self._xtx_cache = (x.copy(), xtx)
+        return self._xtx_cache[1]
+
+    def _compute_functional_from_xtx(self, xtx):
+        """Compute the target function given the matrix product x.T @ x.
+
+        Args:
+          xtx (np.ndarray): The matrix product x.T @ x, of shape (NN, NN).
+
+        Returns:
+          f (float): The value of the target function.
+        """
+        if self._wij is not None:
+            residuals = self._residuals_at_weights(xtx)
+            return 0.5 * np.dot(self._wij.data, np.square(residuals))
+        # Weight the squared residuals in-place to avoid allocating further (NN, NN)
+        # arrays
+        elements = self.rij_matrix - xtx
+        np.square(elements, out=elements)
         if self.wij_matrix is not None:
             np.multiply(self.wij_matrix, elements, out=elements)
-        f = 0.5 * elements.sum()
-        return f
+        return 0.5 * elements.sum()
+
+    def _residuals_at_weights(self, xtx):
+        """Compute the residuals rij - x.T @ x for the elements with non-zero weight.
+
+        Args:
+          xtx (np.ndarray): The matrix product x.T @ x, of shape (NN, NN). Only the
+            upper triangle is read.
+
+        Returns:
+          np.ndarray: The residuals, in the same order as the data of the sparse
+          weights matrix.
+        """
+        return self._rij_at_wij - xtx[self._wij_upper]
+
+    def _functionals_fd(self, x, eps):
+        """Compute the target function with each coordinate perturbed by +/- eps.
+
+        Perturbing a single coordinate x[d, j] only changes row and column j of
+        x.T @ x, so rather than recomputing the full matrix product for each
+        perturbation, x.T @ x is computed once and updated for each coordinate.
+
+        Args:
+          x (np.ndarray): The flattened coordinates.
+          eps (float): The value of epsilon to use in finite difference
+            calculations.
+
+        Yields:
+          Tuple[float, float]: The value of the target function at x + eps and
+          x - eps, for each coordinate in turn.
+        """
+        x = x.reshape((self.dim, x.size // self.dim))
+        xtx = self._compute_xtx(x)
+        for d, j in np.ndindex(x.shape):
+            f = []
+            for delta in (eps, -eps):
+                xtx_delta = xtx.copy()
+                xtx_delta[j, :] += delta * x[d]
+                xtx_delta[:, j] += delta * x[d]
+                xtx_delta[j, j] += delta**2
+                f.append(self._compute_functional_from_xtx(xtx_delta))
+            yield tuple(f)
 
     def compute_gradients_fd(self, x: np.ndarray, eps=1e-6) -> np.ndarray:
         """Compute the gradients at coordinates `x` using finite differences.
@@ -290,16 +496,14 @@ def compute_gradients_fd(self, x: np.ndarray, eps=1e-6) -> np.ndarray:
         Returns:
           grad (np.ndarray):
           The gradients of the target function with respect to the parameters.
+
+        Note:
+          This is intended for testing the analytical gradients, and is much
+          slower than compute_gradients.
         """
-        x = copy.deepcopy(x)
         grad = np.zeros(x.shape)
-        for i in range(x.size):
-            x[i] += eps  # x + eps
-            fp = self.compute_functional(x)
-            x[i] -= 2 * eps  # x - eps
-            fm = self.compute_functional(x)
-            x[i] += eps  # reset to original values
-            grad[i] += (fp - fm) / (2 * eps)
+        for i, (fp, fm) in enumerate(self._functionals_fd(x, eps)):
+            grad[i] = (fp - fm) / (2 * eps)
         return grad
 
     def compute_gradients(self, x: np.ndarray) -> np.ndarray:
@@ -317,11 +521,20 @@ def compute_gradients(self, x: np.ndarray) -> np.ndarray:
           grad: The gradients of the target function with respect to the parameters.
         """
         x = x.reshape((self.dim, x.size // self.dim))
-        if self.wij_matrix is not None:
-            wrij_matrix = np.multiply(self.wij_matrix, self.rij_matrix)
-            grad = -2 * x @ (wrij_matrix - np.multiply(self.wij_matrix, x.T @ x))
+        if self._wij is not None:
+            residuals = scipy.sparse.csr_matrix(
+                (
+                    self._wij.data * self._residuals_at_weights(self._compute_xtx(x)),
+                    self._wij.indices,
+                    self._wij.indptr,
+                ),
+                shape=self._wij.shape,
+            )
         else:
-            grad = -2 * x @ (self.rij_matrix - x.T @ x)
+            residuals = self.rij_matrix - self._compute_xtx(x)
+            if self.wij_matrix is not None:
+                np.multiply(self.wij_matrix, residuals, out=residuals)
+        grad = -2 * x @ residuals
         return grad.flatten()
 
     def curvatures(self, x: np.ndarray) -> np.ndarray:
@@ -337,12 +550,16 @@ def curvatures(self, x: np.ndarray) -> np.ndarray:
           curvs (np.ndarray):
           The curvature of the target function with respect to the parameters.
         """
-        if self.wij_matrix is not None:
-            wij = self.wij_matrix
-        else:
-            wij = np.ones(self.rij_matrix.shape)
         x = x.reshape((self.dim, x.size // self.dim))
-        curvs = 2 * np.square(x) @ wij
+        if self._wij is not None:
+            curvs = 2 * np.square(x) @ self._wij
+        elif self.wij_matrix is not None:
+            curvs = 2 * np.square(x) @ self.wij_matrix
+        else:
+            # With unit weights, each column of np.square(x) @ wij is the row sum
+            curvs = np.repeat(
+                2 * np.square(x).sum(axis=1, keepdims=True), x.shape[1], axis=1
+            )
         return curvs.flatten()
 
     def curvatures_fd(self, x: np.ndarray, eps=1e-6) -> np.ndarray:
@@ -359,17 +576,15 @@ def curvatures_fd(self, x: np.ndarray, eps=1e-6) -> np.ndarray:
         Returns:
           curvs (np.ndarray):
           The curvature of the target function with respect to the parameters.
+
+        Note:
+          This is intended for testing the analytical curvatures, and is much
+          slower than curvatures.
         """
-        x = copy.deepcopy(x)
         f = self.compute_functional(x)
         curvs = np.zeros(x.shape)
-        for i in range(x.size):
-            x[i] += eps  # x + eps
-            fp = self.compute_functional(x)
-            x[i] -= 2 * eps  # x - eps
-            fm = self.compute_functional(x)
-            x[i] += eps  # reset to original values
-            curvs[i] += (fm - 2 * f + fp) / (eps**2)
+        for i, (fp, fm) in enumerate(self._functionals_fd(x, eps)):
+            curvs[i] = (fm - 2 * f + fp) / (eps**2)
         return curvs
 
     def get_sym_ops(self):
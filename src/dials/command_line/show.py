@@ -4,6 +4,7 @@
 import sys
 
 import numpy as np
+from orderedset import OrderedSet
 
 import iotbx.phil
 from cctbx import uctbx
@@ -11,6 +12,7 @@
 from scitbx.math import five_number_summary
 
 import dials.util
+from dials.algorithms.shoebox import MaskCode
 from dials.array_family import flex
 from dials.util import Sorry, tabulate
 
@@ -433,8 +435,6 @@ def show_reflections(
 
     text = []
 
-    from orderedset import OrderedSet
-
     formats = {
         "miller_index": "%i, %i, %i",
         "d": "%.2f",
@@ -491,10 +491,8 @@ def show_reflections(
         "inverse_scale_factor_variance": "%.3f",
     }
 
+    foreground_valid = MaskCode.Valid | MaskCode.Foreground
     for rlist in reflections:
-        from dials.algorithms.shoebox import MaskCode
-
-        foreground_valid = MaskCode.Valid | MaskCode.Foreground
         text.append("")
         text.append(f"Reflection list contains {len(rlist)} reflections")
 
@@ -516,12 +514,13 @@ def show_reflections(
             elif type(col) in (flex.double, flex.int, flex.size_t):
                 if type(col) in (flex.int, flex.size_t):
                     col = col.as_double()
+                mmm = flex.min_max_mean_double(col)
                 rows.append(
                     [
                         k,
-                        formats.get(k, "%s") % flex.min(col),
-                        formats.get(k, "%s") % flex.max(col),
-                        formats.get(k, "%s") % flex.mean(col),
+                        formats.get(k, "%s") % mmm.min,
+                        formats.get(k, "%s") % mmm.max,
+                        formats.get(k, "%s") % mmm.mean,
                     ]
                 )
             elif type(col) in (flex.vec3_double, flex.miller_index):
@@ -538,33 +537,24 @@ def show_reflections(
             elif isinstance(col, flex.shoebox):
                 rows.append([k, "", "", ""])
                 si = col.summed_intensity().observed_value()
-                rows.append(
-                    [
-                        "  summed I",
-                        formats.get(k, "%s") % flex.min(si),
-                        formats.get(k, "%s") % flex.max(si),
-                        formats.get(k, "%s") % flex.mean(si),
-                    ]
-                )
                 x1, x2, y1, y2, z1, z2 = col.bounding_boxes().parts()
                 bbox_sizes = ((z2 - z1) * (y2 - y1) * (x2 - x1)).as_double()
-                rows.append(
-                    [
-                        "  N pix",
-                        formats.get(k, "%s") % flex.min(bbox_sizes),
-                        formats.get(k, "%s") % flex.max(bbox_sizes),
-                        formats.get(k, "%s") % flex.mean(bbox_sizes),
-                    ]
-                )
                 fore_valid = col.count_mask_values(foreground_valid).as_double()
-                rows.append(
-                    [
-                        "  N valid foreground pix",
-                        formats.get(k, "%s") % flex.min(fore_valid),
-                        formats.get(k, "%s") % flex.max(fore_valid),
-                        formats.get(k, "%s") % flex.mean(fore_valid),
-                    ]
-                )
+                # Find the min, max and mean of each in a single pass over the values
+                for label, values in (
+                    ("  summed I", si),
+                    ("  N pix", bbox_sizes),
+                    ("  N valid foreground pix", fore_valid),
+                ):
+                    mmm = flex.min_max_mean_double(values)
+                    rows.append(
+                        [
+                            label,
+                            formats.get(k, "%s") % mmm.min,
+                            formats.get(k, "%s") % mmm.max,
+                            formats.get(k, "%s") % mmm.mean,
+                        ]
+                    )
 
         text.append(tabulate(rows, headers="firstrow"))
 
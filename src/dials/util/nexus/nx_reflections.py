@@ -6,8 +6,16 @@
 
 
 def make_dataset(handle, name, dtype, data, description, units=None):
+    # Store the reflection columns chunked and compressed with a fast gzip level,
+    # which shrinks the file considerably for little extra CPU time
     dset = handle.create_dataset(
-        name, data.focus(), dtype=dtype, data=data.as_numpy_array().astype(dtype)
+        name,
+        data.focus(),
+        dtype=dtype,
+        data=data.as_numpy_array().astype(dtype),
+        chunks=True,
+        compression="gzip",
+        compression_opts=1,
     )
     dset.attrs["description"] = description
     if units is not None:
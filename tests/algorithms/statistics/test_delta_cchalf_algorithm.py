@@ -2,11 +2,25 @@
 
 from __future__ import annotations
 
+import random
+from collections import defaultdict
 from unittest import mock
 
+import numpy as np
+import pytest
+
+from cctbx import sgtbx, uctbx
 from dxtbx.model import Crystal, Experiment, ExperimentList, Scan
 
 from dials.algorithms.statistics.cc_half_algorithm import CCHalfFromDials
+from dials.algorithms.statistics.delta_cchalf import (
+    BinData,
+    PerGroupCChalfStatistics,
+    ReflectionSum,
+    _compute_mean_cchalf_from_bin_moments,
+    compute_cchalf_from_reflection_sums,
+    compute_mean_cchalf_in_bins,
+)
 from dials.array_family import flex
 from dials.command_line.compute_delta_cchalf import phil_scope
 
@@ -118,3 +132,55 @@ def mock_algorithm(*_):
         assert script.results_summary["dataset_removal"][
             "experiments_fully_removed"
         ] == ["0"]
+
+
+def test_PerGroupCChalfStatistics_excluding_each_group():
+    """Compare the CC½ excluding each group against a direct calculation."""
+    random.seed(0)
+    indices = [(h, k, l) for h in range(1, 6) for k in range(1, 6) for l in range(1, 9)]
+    true_intensities = {h: random.uniform(0, 1000) for h in indices}
+    miller_indices = [random.choice(indices) for _ in range(2000)]
+
+    table = flex.reflection_table()
+    table["miller_index"] = flex.miller_index(miller_indices)
+    table["intensity"] = flex.double(
+        [true_intensities[h] + random.gauss(0, 100) for h in miller_indices]
+    )
+    table["variance"] = flex.double(2000, 1.0)
+    table["dataset"] = flex.int(2000, 0)
+    table["group"] = flex.int([i % 8 for i in range(2000)])
+
+    statistics = PerGroupCChalfStatistics(
+        table,
+        uctbx.unit_cell((10, 10, 10, 90, 90, 90)),
+        sgtbx.space_group_info("P1").group(),
+        n_bins=4,
+    )
+    statistics.run()
+    cchalf_i = statistics.cchalf_i()
+    assert sorted(cchalf_i) == list(range(8))
+
+    for group, cchalf in cchalf_i.items():
+        reflection_sums = defaultdict(ReflectionSum)
+        sel = statistics.reflection_table["group"] != group
+        for h, i in zip(
+            statistics.reflection_table["miller_index"].select(sel),
+            statistics.reflection_table["intensity"].select(sel),
+        ):
+            reflection_sums[h].sum_x += i
+            reflection_sums[h].sum_x2 += i**2
+            reflection_sums[h].n += 1
+        expected = compute_cchalf_from_reflection_sums(
+            reflection_sums, statistics.binner
+        )
+        assert cchalf == pytest.approx(expected)
+
+
+def test_mean_cchalf_from_bin_moments_no_usable_bins():
+    """Without any bin of more than one unique reflection, the mean CC½ is
+    undefined, and both implementations raise rather than return nan."""
+    with pytest.raises(ZeroDivisionError):
+        compute_mean_cchalf_in_bins([BinData(), BinData()])
+    moments = np.array([[1, 0], [2.0, 0], [4.0, 0], [0.5, 0]])
+    with pytest.raises(ZeroDivisionError):
+        _compute_mean_cchalf_from_bin_moments(moments)
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import numpy as np
+import pandas as pd
 import pytest
 
 from cctbx import sgtbx
@@ -52,3 +53,97 @@ def test_cosym_target(space_group):
         assert f < f0
         assert pytest.approx(g, abs=1e-3) == [0] * len(g)
         assert pytest.approx(g_fd, abs=1e-3) == [0] * len(g)
+
+
+def test_cosym_target_sparse_weights():
+    datasets, _ = generate_test_data(
+        space_group=sgtbx.space_group_info(symbol="P3").group(), sample_size=6
+    )
+
+    # Restrict each dataset to a separate resolution shell, so that no two
+    # datasets share any reflections and most of the weights are zero
+    d_star_sq = datasets[0].d_star_sq().data()
+    edges = np.linspace(flex.min(d_star_sq), flex.max(d_star_sq), len(datasets) + 1)
+    gap = 0.1 * (edges[1] - edges[0])
+    datasets = [
+        d.select((d.d_star_sq().data() > lower + gap) & (d.d_star_sq().data() < upper))
+        for d, lower, upper in zip(datasets, edges[:-1], edges[1:])
+    ]
+
+    intensities = datasets[0]
+    dataset_ids = np.zeros(intensities.size())
+    for i, d in enumerate(datasets[1:]):
+        i += 1
+        intensities = intensities.concatenate(d, assert_is_similar_symmetry=False)
+        dataset_ids = np.concatenate([dataset_ids, np.full(d.size(), i)])
+
+    for weights in ["count", "standard_error"]:
+        t = target.Target(intensities, dataset_ids, weights=weights)
+        assert t._wij is not None
+
+        x = flex.random_double(t.rij_matrix.shape[0] * t.dim).as_numpy_array()
+        xx = x.reshape((t.dim, -1))
+
+        # Only the upper triangle of x.T @ x is calculated
+        np.testing.assert_allclose(
+            np.triu(t._compute_xtx(xx)), np.triu(xx.T @ xx), rtol=1e-12
+        )
+
+        # Compare with the dense expressions for the weighted target
+        residuals = t.rij_matrix - xx.T @ xx
+        wij = t.wij_matrix
+        assert t.compute_functional(x) == pytest.approx(
+            0.5 * np.sum(wij * np.square(residuals))
+        )
+        np.testing.assert_allclose(
+            t.compute_gradients(x), (-2 * xx @ (wij * residuals)).flatten()
+        )
+        np.testing.assert_allclose(t.curvatures(x), (2 * np.square(xx) @ wij).flatten())
+        g = t.compute_gradients(x)
+        np.testing.assert_allclose(
+            g, t.compute_gradients_fd(x), rtol=2e-3, atol=1e-6 * np.abs(g).max()
+        )
+
+
+def test_compute_pairwise_correlations():
+    rng = np.random.default_rng(0)
+    n_rows, n_cols, min_pairs = 13, 40, 3
+
+    # A random sparse matrix of intensities, where the last row has too few
+    # intensities to calculate any correlation coefficients
+    rows = rng.integers(0, n_rows - 1, 300)
+    columns = rng.integers(0, n_cols, 300)
+    data = rng.normal(100, 30, 300)
+    rows = np.concatenate([rows, [n_rows - 1, n_rows - 1]])
+    columns = np.concatenate([columns, [0, 1]])
+    data = np.concatenate([data, [50.0, 60.0]])
+    # A miller index that occurs twice in the same row, of which only the last
+    # intensity is kept
+    rows = np.concatenate([rows, [0, 0]])
+    columns = np.concatenate([columns, [5, 5]])
+    data = np.concatenate([data, [10.0, 20.0]])
+
+    dense = np.full((n_rows, n_cols), np.nan)
+    dense[rows, columns] = data
+    assert dense[0, 5] == 20.0
+
+    intensities = target._intensities_as_sparse_matrix(
+        rows, columns, data, (n_rows, n_cols)
+    )
+    np.testing.assert_array_equal(intensities.toarray(), np.nan_to_num(dense))
+
+    # Evaluate in blocks smaller than the number of rows
+    rij, n = target._compute_pairwise_correlations(intensities, min_pairs, block_size=4)
+
+    # Compare with the pairwise-complete correlation coefficients from pandas
+    expected_rij = pd.DataFrame(dense).T.corr(min_periods=min_pairs).values.copy()
+    np.nan_to_num(expected_rij, copy=False)
+    np.fill_diagonal(expected_rij, 0)
+    np.fill_diagonal(rij, 0)
+    np.testing.assert_allclose(rij, expected_rij, atol=1e-12)
+    assert np.all(rij[-1] == 0)
+    np.testing.assert_array_equal(rij, rij.T)
+
+    # The number of common columns for each pair of rows
+    present = np.isfinite(dense).astype(int)
+    np.testing.assert_array_equal(n, present @ present.T)